@@ -0,0 +1,210 @@
+
+"""Micro-benchmarks for bl's hot paths.
+
+Each benchmark is a setup function, registered with @benchmark, that builds its inputs
+from a seeded random.Random (so the inputs are the same on every run) and returns a
+zero-argument function to be timed. Results are the best time per call over several
+repeats, in seconds, and can be saved as JSON and compared against a saved baseline.
+
+    $ python -m bl.bench --save baseline.json
+    $ python -m bl.bench --baseline baseline.json --threshold 0.2
+
+The second run exits with a non-zero status if any benchmark is more than 20% slower
+than its baseline. Use bl.instrument to see where time goes in a real application.
+
+>>> results = run(['dict_keys'], repeat=1, number=10)
+>>> list(results.keys())
+['dict_keys']
+>>> compare(Dict(a=1.25, b=1.0), Dict(a=1.0, b=1.0), threshold=0.2)
+{'a': 1.25}
+"""
+
+import json, os, random, shutil, sys, tempfile, timeit
+from bl.dict import Dict
+
+SEED = 20161018
+MTIME = 1476748800          # 2016-10-18
+BENCHMARKS = {}             # name => (setup function, number of calls per repeat)
+
+def benchmark(number=1000):
+    """register the decorated setup function as a benchmark, timed over number calls.
+    setup(rng, tmp) is given a seeded random.Random and a temporary directory,
+    and returns the function to be timed.
+    """
+    def register(setup):
+        BENCHMARKS[setup.__name__] = (setup, number)
+        return setup
+    return register
+
+def _words(rng, n, length=8):
+    from bl.id import lcase_chars
+    return [''.join(rng.choice(lcase_chars) for i in range(length)) for j in range(n)]
+
+def _make_tree(rng, path, dirs=20, files=50, size=4096):
+    """create a tree of dirs directories with files files each, of compressible text"""
+    words = _words(rng, 200)
+    for d in range(dirs):
+        dn = os.path.join(path, 'd%02d' % (d // 5), 'd%02d' % d)
+        os.makedirs(dn)
+        for f in range(files):
+            with open(os.path.join(dn, 'f%03d.%s' % (f, rng.choice(['txt', 'xml', 'py']))), 'w') as fp:
+                text = ' '.join(rng.choice(words) for i in range(size // 8))
+                fp.write(text[:size])
+    # fixed mtimes, so that archives are reproducible and directory listings can be cached
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        for fn in filenames + dirnames + ['']:
+            os.utime(os.path.join(dirpath, fn), (MTIME, MTIME))
+    return path
+
+@benchmark(number=10000)
+def dict_construct(rng, tmp):
+    from bl.dict import Dict
+    kwargs = {k: rng.randint(0, 1000) for k in _words(rng, 20)}
+    return lambda: Dict(**kwargs)
+
+@benchmark(number=10000)
+def dict_update(rng, tmp):
+    from bl.dict import Dict
+    d = Dict()
+    kwargs = {k: rng.randint(0, 1000) for k in _words(rng, 10)}
+    kwargs.update(nested={'a': 1, 'b': [1, 2, {'c': 3}]}, items=[{'x': 1}, 2, b'bytes'])
+    return lambda: d.update(**kwargs)
+
+@benchmark(number=10000)
+def dict_keys(rng, tmp):
+    from bl.dict import Dict
+    d = Dict(**{k: 1 for k in _words(rng, 100)})
+    return d.keys
+
+@benchmark(number=200)
+def config_parse(rng, tmp):
+    from bl.config import Config
+    fn = os.path.join(os.path.dirname(__file__), 'config_test.ini')
+    return lambda: Config(fn)
+
+@benchmark(number=1000)
+def log_write(rng, tmp):
+    from bl.log import Log
+    log = Log(fn=os.path.join(tmp, 'logs', 'bench.log'))
+    line = ' '.join(_words(rng, 10))
+    return lambda: log(line)
+
+@benchmark(number=5000)
+def url_parse(rng, tmp):
+    from bl.url import URL
+    url = 'http://example.com:8080/%s;p?%s#frag' % (
+        '/'.join(_words(rng, 4)), '&'.join('%s=%s' % kv for kv in zip(_words(rng, 3), _words(rng, 3))))
+    return lambda: URL(url)
+
+@benchmark(number=5000)
+def url_str(rng, tmp):
+    from bl.url import URL
+    u = URL('http://example.com/%s?a=1&b=2' % '/'.join(_words(rng, 4)))
+    return lambda: str(u)
+
+@benchmark(number=2000)
+def url_derive(rng, tmp):
+    from bl.url import URL
+    u = URL('http://example.com/%s?a=1&b=2' % '/'.join(_words(rng, 4)))
+    path = '/' + '/'.join(_words(rng, 3))
+    return lambda: u(path=path).drop_qarg('a').parent()
+
+@benchmark(number=2000)
+def string_transforms(rng, tmp):
+    from bl.string import String
+    s = String(' '.join(_words(rng, 4) + ['of', 'the'] + _words(rng, 4)) + ' CamelCase')
+    return lambda: (s.titleify(), s.camelify(), s.hyphenify(), s.identifier(camelsplit=True))
+
+@benchmark(number=10000)
+def random_id(rng, tmp):
+    from bl.id import random_id
+    return random_id
+
+@benchmark(number=10000)
+def sortable_id(rng, tmp):
+    from bl.id import sortable_id
+    return sortable_id
+
+@benchmark(number=10)
+def rglob(rng, tmp):
+    from bl.rglob import rglob
+    path = _make_tree(rng, os.path.join(tmp, 'tree'), size=16)
+    return lambda: rglob(path, '*.py')
+
+@benchmark(number=10)
+def rglob_index(rng, tmp):
+    from bl.rglob import rglob, FileIndex
+    path = _make_tree(rng, os.path.join(tmp, 'tree'), size=16)
+    index = FileIndex(os.path.join(tmp, 'index.json'))
+    rglob(path, '*.py', index=index)
+    return lambda: rglob(path, '*.py', index=index)
+
+@benchmark(number=1)
+def zip_path(rng, tmp):
+    from bl.zip import ZIP
+    path = _make_tree(rng, os.path.join(tmp, 'tree'), dirs=10, files=20)
+    return lambda: ZIP.zip_path(path, fn=os.path.join(tmp, 'tree.zip'))
+
+@benchmark(number=1)
+def zip_path_parallel(rng, tmp):
+    from bl.zip import ZIP
+    path = _make_tree(rng, os.path.join(tmp, 'tree'), dirs=10, files=20)
+    return lambda: ZIP.zip_path(path, fn=os.path.join(tmp, 'tree.zip'), workers=4)
+
+def run(names=None, repeat=5, number=None, log=None):
+    """run the named benchmarks (default all), return a Dict of name => best seconds per call.
+        repeat=5        = the number of times to repeat each benchmark
+        number=None     = the number of calls per repeat (None = the benchmark's own number)
+        log=None        = if given, a Log (or print-like function) to report each result
+    """
+    results = Dict()
+    for name in names or sorted(BENCHMARKS.keys()):
+        setup, n = BENCHMARKS[name]
+        n = number or n
+        tmp = tempfile.mkdtemp(prefix='bl-bench-')
+        try:
+            fn = setup(random.Random(SEED), tmp)
+            results[name] = min(timeit.repeat(fn, repeat=repeat, number=n)) / n
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        if log is not None:
+            log("%-20s %12.3f us" % (name, results[name] * 1e6))
+    return results
+
+def save(results, fn):
+    """save results to fn as JSON"""
+    with open(fn, 'w') as f:
+        f.write(results.json(indent=2))
+
+def load(fn):
+    """load results saved with save()"""
+    with open(fn, 'r') as f:
+        return Dict(**json.load(f))
+
+def compare(results, baseline, threshold=0.1):
+    """return a Dict of name => ratio (results / baseline) for every benchmark that is
+    more than threshold (as a fraction) slower than its baseline.
+    """
+    return Dict(**{
+        name: results[name] / baseline[name]
+        for name in results.keys()
+        if baseline.get(name) and results[name] / baseline[name] > 1 + threshold})
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="run bl's micro-benchmarks")
+    parser.add_argument('names', nargs='*', help="benchmarks to run (default all)")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', help="save the results to this JSON file")
+    parser.add_argument('--baseline', help="compare the results to this saved JSON file")
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help="the fraction slower than the baseline that counts as a regression")
+    args = parser.parse_args()
+    results = run(args.names, repeat=args.repeat, log=print)
+    if args.save is not None:
+        save(results, args.save)
+    if args.baseline is not None:
+        regressions = compare(results, load(args.baseline), threshold=args.threshold)
+        for name in regressions.keys():
+            print("REGRESSION: %s is %.2fx its baseline" % (name, regressions[name]))
+        sys.exit(int(len(regressions) > 0))
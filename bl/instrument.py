@@ -0,0 +1,165 @@
+
+"""Opt-in instrumentation of bl's hot paths: call counters and cumulative timers.
+
+Nothing is instrumented until enable() is called, so there is no cost when it is off.
+enable() wraps the named functions and methods in place, and disable() restores them.
+Note that code which imported a function by name before enable() (e.g.,
+"from bl.rglob import rglob") keeps the uninstrumented function; methods are always covered.
+
+>>> from bl.dict import Dict
+>>> enable(['bl.dict:Dict.update'])
+>>> d = Dict(a=1); d.update(b=2)
+>>> stats()['bl.dict:Dict.update'].calls
+2
+>>> disable(); reset()
+>>> stats()
+{}
+
+An inherited method is wrapped on the named class only, not on the class that defines it:
+>>> from bl.config import Config
+>>> enable(['bl.config:Config.update'])
+>>> 'update' in Config.__dict__, Dict.update is Dict.__dict__['update']
+(True, True)
+>>> disable(); reset()
+>>> 'update' in Config.__dict__, Config.update is Dict.update
+(False, True)
+
+Only the outermost call is counted when an instrumented function calls itself:
+>>> import os, bl.rglob
+>>> enable(['bl.rglob:irglob'])
+>>> fns = list(bl.rglob.irglob(os.path.dirname(__file__), '*.py', sort=True))
+>>> stats()['bl.rglob:irglob'].calls
+1
+>>> disable(); reset()
+"""
+
+import functools, importlib, inspect, threading, time
+from bl.dict import Dict
+
+# the functions and methods that enable() instruments by default
+TARGETS = [
+    'bl.dict:Dict.__init__', 'bl.dict:Dict.update', 'bl.dict:Dict.keys', 'bl.dict:Dict.__call__',
+    'bl.config:Config.__init__', 'bl.config:Config.parse_config', 'bl.config:Config.write',
+    'bl.log:Log.__call__',
+    'bl.url:URL.__init__', 'bl.url:URL.__str__', 'bl.url:URL.__call__',
+    'bl.string:String.titleify', 'bl.string:String.hyphenify', 'bl.string:String.camelsplit',
+    'bl.id:random_id', 'bl.id:sortable_id',
+    'bl.rglob:irglob', 'bl.rglob:FileIndex.listing',
+    'bl.zip:ZIP.zip_path', 'bl.zip:ZIP.update_path', 'bl.zip:ZIP.unzip',
+]
+
+_lock = threading.Lock()
+_local = threading.local()      # .active = the set of targets running in this thread
+_stats = {}             # target => [calls, seconds]
+_originals = {}         # target => (owner, attribute name, original value, owner defined it)
+
+def enable(targets=None):
+    """instrument the given targets (default TARGETS), each a string 'module:attr[.attr]'"""
+    for target in targets or TARGETS:
+        if target in _originals:
+            continue
+        module_name, path = target.split(':')
+        owner = importlib.import_module(module_name)
+        names = path.split('.')
+        for name in names[:-1]:
+            owner = getattr(owner, name)
+        name = names[-1]
+        if isinstance(owner, type):
+            # the raw attribute (so classmethods stay classmethods), which can be inherited
+            for klass in owner.__mro__:
+                if name in klass.__dict__:
+                    original = klass.__dict__[name]
+                    break
+            else:
+                raise AttributeError("%s: %r has no attribute %r" % (target, owner, name))
+            defined = name in owner.__dict__
+        else:
+            original = getattr(owner, name)
+            defined = True
+        _originals[target] = (owner, name, original, defined)
+        setattr(owner, name, _wrap(target, original))
+
+def disable():
+    """remove all instrumentation, restoring the original functions and methods"""
+    for target in list(_originals.keys()):
+        owner, name, original, defined = _originals.pop(target)
+        if defined==True:
+            setattr(owner, name, original)
+        else:
+            delattr(owner, name)    # an inherited method: the subclass gets it back by lookup
+
+def reset():
+    """clear the collected counts and timings"""
+    with _lock:
+        _stats.clear()
+
+def stats():
+    """return a Dict of target => Dict(calls, seconds) for every target that has been called.
+    Times are cumulative, so nested calls of different targets (e.g., Dict.update within 
+    Dict.__init__) are counted in both; recursive calls of one target are counted once.
+    """
+    with _lock:
+        items = [(target, s[0], s[1]) for target, s in _stats.items()]
+    # Dict itself might be instrumented, so it is built outside the lock
+    return Dict(**{target: Dict(calls=calls, seconds=seconds) for target, calls, seconds in items})
+
+def report(log=print, sort='seconds'):
+    """log the collected stats, sorted by 'seconds' or 'calls' (descending)"""
+    s = stats()
+    for target in sorted(s.keys(), key=lambda t: s[t][sort], reverse=True):
+        log("%10d calls %10.4fs  %s" % (s[target].calls, s[target].seconds, target))
+
+def _wrap(target, original):
+    """wrap original, which might be a classmethod or staticmethod, to count its calls and time"""
+    if isinstance(original, (classmethod, staticmethod)):
+        return type(original)(_wrap(target, original.__func__))
+    if inspect.isgeneratorfunction(original):
+        # time each step of the generator, not the consumer's work between steps
+        @functools.wraps(original)
+        def wrapper(*args, **kwargs):
+            gen = original(*args, **kwargs)
+            if target in _active():
+                yield from gen
+                return
+            _count(target, 1, 0.0)
+            try:
+                while True:
+                    active = _active()
+                    active.add(target)
+                    start = time.perf_counter()
+                    try:
+                        value = next(gen)
+                    except StopIteration:
+                        return
+                    finally:
+                        active.discard(target)
+                        _count(target, 0, time.perf_counter() - start)
+                    yield value
+            finally:
+                gen.close()
+        return wrapper
+    @functools.wraps(original)
+    def wrapper(*args, **kwargs):
+        active = _active()
+        if target in active:
+            return original(*args, **kwargs)
+        active.add(target)
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            active.discard(target)
+            _count(target, 1, time.perf_counter() - start)
+    return wrapper
+
+def _active():
+    """the set of instrumented targets that are running in this thread"""
+    if not hasattr(_local, 'active'):
+        _local.active = set()
+    return _local.active
+
+def _count(target, calls, seconds):
+    with _lock:
+        s = _stats.setdefault(target, [0, 0.0])
+        s[0] += calls
+        s[1] += seconds
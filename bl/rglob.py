@@ -1,21 +1,289 @@
 
-import os
-from glob import glob, escape
+import os, re, json, threading, time
+from fnmatch import translate
+from bl.dict import Dict
 
-def rglob(dirname, pattern, dirs=False, sort=True):
+def rglob(dirname, pattern, dirs=False, sort=True, threads=0, index=None):
     """recursive glob, gets all files that match the pattern within the directory tree"""
-    fns = []
-    if os.path.isdir(dirname):
-        fns = glob(os.path.join(dirname, pattern))
-        dns = [fn for fn 
-                in [escape(os.path.join(dirname, fn)) 
-                    for fn in os.listdir(dirname)] 
-                if os.path.isdir(fn)]
-        if dirs==True:
-            fns += dns
-        for d in dns:
-            if os.path.isdir(d):
-                fns += rglob(d, pattern)
-        if sort==True:
-            fns.sort()
+    fns = list(irglob(dirname, pattern, dirs=dirs, threads=threads, index=index))
+    if sort==True:
+        fns.sort()
     return fns
+
+def irglob(dirname, pattern, dirs=False, sort=False, threads=0, followlinks=True, index=None):
+    """recursive glob as an iterator, which yields paths as the tree is walked.
+        dirname             = the root of the tree to walk
+        pattern             = a glob pattern that is matched against each basename; a
+                                pattern with path separators, like '*/*.py', is matched
+                                against the trailing parts of each path under dirname,
+                                which is what glob() does in each directory of the tree
+        dirs=False          = if True, also yield every directory in the tree
+        sort=False          = if True, collect and sort the results before yielding them
+        threads=0           = if > 0, scan directories in a thread pool of this size
+        followlinks=True    = whether to descend into symlinked directories
+        index=None          = a FileIndex (or its filename) holding cached directory listings
+    Built on os.scandir(), so the file type comes from the directory entry without a stat
+    call, and the tree is walked without recursion. A symlink that points back to one of
+    the directories above it in the walk is not followed, so link loops terminate.
+    As with glob(), names beginning with '.' only match a pattern that begins with '.'.
+    >>> here = os.path.dirname(__file__)
+    >>> os.path.join(here, 'rglob.py') in irglob(here, 'rgl?b.py')
+    True
+
+    Symlinks that point at each other are followed once each:
+    >>> import tempfile
+    >>> lp = tempfile.mkdtemp()
+    >>> for d in ['a', 'b']: os.mkdir(os.path.join(lp, d))
+    >>> for fn in ['a/1.txt', 'b/2.txt']: open(os.path.join(lp, fn), 'w').close()
+    >>> os.symlink('../b', os.path.join(lp, 'a', 'x')); os.symlink('../a', os.path.join(lp, 'b', 'y'))
+    >>> [os.path.relpath(fn, lp) for fn in rglob(lp, '*.txt')]
+    ['a/1.txt', 'a/x/2.txt', 'b/2.txt', 'b/y/1.txt']
+    >>> rglob(lp, '*.txt', threads=2) == rglob(lp, '*.txt')
+    True
+    >>> [os.path.relpath(fn, lp) for fn in rglob(lp, '*/1.txt')]
+    ['a/1.txt', 'b/y/1.txt']
+    >>> [os.path.relpath(fn, lp) for fn in rglob(lp, 'a/*/*.txt')]
+    ['a/x/2.txt']
+    >>> import shutil; shutil.rmtree(lp)
+    """
+    if sort==True:
+        yield from sorted(irglob(dirname, pattern, dirs=dirs, threads=threads,
+                                followlinks=followlinks, index=index))
+        return
+    if isinstance(index, str):
+        index = FileIndex(index)
+    seps = '[%s]' % re.escape(os.sep + (os.path.altsep or ''))
+    parts = [part for part in re.split(seps, pattern) if part != '']
+    matchers = [(re.compile(translate(os.path.normcase(part))).match, part.startswith('.'))
+                for part in parts]
+    def matches(names):
+        return all((hidden or not name.startswith('.')) 
+                    and match(os.path.normcase(name)) is not None
+                    for (match, hidden), name in zip(matchers, names))
+    scandir = index.scandir if index is not None else _scandir
+    for path, entries in walk(dirname, scandir=scandir, threads=threads, followlinks=followlinks):
+        if len(matchers) > 1:
+            relpath = os.path.relpath(path, dirname)
+            dirnames = [] if relpath == os.curdir else relpath.split(os.sep)
+            dirnames = dirnames[len(dirnames) - len(matchers) + 1:] \
+                if len(dirnames) >= len(matchers) - 1 else None
+        else:
+            dirnames = []
+        for name, is_dir, is_link in entries:
+            if dirnames is not None and matches(dirnames + [name]):
+                yield os.path.join(path, name)
+            elif dirs==True and is_dir:
+                yield os.path.join(path, name)
+    if index is not None:
+        index.save()
+
+def walk(dirname, scandir=None, threads=0, followlinks=True):
+    """walk the tree under dirname, yielding (path, [(name, is_dir, is_link), ...])
+    for each directory. scandir(path) returns the entries of one directory,
+    and defaults to listing it with os.scandir().
+    """
+    if not os.path.isdir(dirname):
+        return
+    scandir = scandir or _scandir
+    root = (dirname, os.path.realpath(dirname), None)
+    if threads > 0:
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = {executor.submit(_scan_dir, root, scandir, followlinks)}
+            while len(pending) > 0:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, entries, subdirs = future.result()
+                    yield path, entries
+                    for subdir in subdirs:
+                        pending.add(executor.submit(_scan_dir, subdir, scandir, followlinks))
+    else:
+        stack = [root]
+        while len(stack) > 0:
+            path, entries, subdirs = _scan_dir(stack.pop(), scandir, followlinks)
+            yield path, entries
+            stack += reversed(subdirs)
+
+def _scandir(path):
+    """list one directory as [(name, is_dir, is_link), ...], or [] if it can't be read"""
+    entries = []
+    try:
+        it = os.scandir(path)
+    except OSError:         # unreadable or vanished since it was listed
+        return entries
+    with it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            entries.append((entry.name, is_dir, entry.is_symlink()))
+    return entries
+
+def _scan_dir(d, scandir, followlinks):
+    """scan one directory, return (path, entries, subdirs), where d and each of subdirs is 
+    (path, realpath, ancestors) and ancestors is a (realpath, ancestors) chain of the 
+    directories above it in this branch of the walk.
+    """
+    path, realpath, ancestors = d
+    chain = (realpath, ancestors)
+    entries = scandir(path)
+    subdirs = []
+    for name, is_dir, is_link in entries:
+        if not is_dir:
+            continue
+        if not is_link:
+            subdirs.append((os.path.join(path, name), os.path.join(realpath, name), chain))
+        elif followlinks==True:
+            target = os.path.realpath(os.path.join(path, name))
+            if not realpath.startswith(os.path.join(target, '')) \
+            and not _in_chain(target, chain):
+                subdirs.append((os.path.join(path, name), target, chain))
+    return path, entries, subdirs
+
+def _in_chain(realpath, chain):
+    """whether realpath has already been visited in this branch of the walk"""
+    while chain is not None:
+        if chain[0] == realpath:
+            return True
+        chain = chain[1]
+    return False
+
+class FileIndex(Dict):
+    """persistent index of directory listings, keyed by absolute path and directory mtime.
+    A directory is only re-listed when its mtime has changed, so walking an unchanged tree
+    costs one stat per directory rather than a listing of every directory.
+        fn          = the JSON file in which the index is stored (created on save)
+    Pass a FileIndex to rglob() or irglob() as index= to use it; use changes() to find the
+    files added, removed, and modified since the last call to changes() on the same path.
+    Each changes() path has its own snapshot, which rglob() and irglob() don't touch.
+    >>> import tempfile
+    >>> tmp = tempfile.mkdtemp(); tree = os.path.join(tmp, 'tree')
+    >>> os.makedirs(os.path.join(tree, 'a'))
+    >>> for fn in ['a/1.txt', 'a/2.txt']: open(os.path.join(tree, fn), 'w').close()
+    >>> index = FileIndex(os.path.join(tmp, 'index.json'))
+    >>> [os.path.relpath(fn, tree) for fn in index.changes(tree).added]
+    ['a/1.txt', 'a/2.txt']
+    >>> open(os.path.join(tree, 'a/3.txt'), 'w').close()
+    >>> os.remove(os.path.join(tree, 'a/1.txt'))
+    >>> with open(os.path.join(tree, 'a/2.txt'), 'w') as f: _ = f.write('edited in place')
+    >>> len(rglob(tree, '*.txt', index=index))
+    2
+    >>> changes = FileIndex(os.path.join(tmp, 'index.json')).changes(tree)
+    >>> [[os.path.relpath(fn, tree) for fn in changes[k]] for k in ['added', 'removed', 'modified']]
+    [['a/3.txt'], ['a/1.txt'], ['a/2.txt']]
+    >>> FileIndex(os.path.join(tmp, 'index.json')).changes(tree)
+    {'added': [], 'modified': [], 'removed': []}
+    >>> import shutil; shutil.rmtree(tmp)
+    """
+
+    # a directory modified this recently might change again within the same mtime tick,
+    # so its listing is kept but not trusted (the "racy timestamp" problem).
+    RACY_SECONDS = 2
+
+    def __init__(self, fn, **args):
+        Dict.__init__(self, fn=fn, **args)
+        self.__dict__['dirs'] = {}          # dirpath => {'mtime': mtime_ns, 'entries': [...]}
+        self.__dict__['snapshots'] = {}     # changes() path => {filepath: [size, mtime_ns]}
+        self.__dict__['lock'] = threading.Lock()
+        self.__dict__['dirty'] = False
+        if os.path.exists(fn):
+            with open(fn, 'r') as f:
+                data = json.load(f)
+            self.__dict__['dirs'] = data.get('dirs') or {}
+            self.__dict__['snapshots'] = data.get('snapshots') or {}
+
+    def save(self, fn=None):
+        """write the index to fn or self.fn, if it has changed"""
+        fn = fn or self.fn
+        if self.dirty != True and os.path.exists(fn):
+            return
+        with self.lock:
+            data = json.dumps({'dirs': self.dirs, 'snapshots': self.snapshots})
+            self.__dict__['dirty'] = False
+        with open(fn + '.tmp', 'w') as f:
+            f.write(data)
+        os.replace(fn + '.tmp', fn)
+
+    def scandir(self, path):
+        """list one directory as [(name, is_dir, is_link), ...], from the index if the
+        directory's mtime is unchanged, otherwise from disk.
+        """
+        return [(e[0], e[1], e[2]) for e in self.listing(path)]
+
+    def listing(self, path, stat_files=False):
+        """return [[name, is_dir, is_link, size, mtime_ns], ...] for one directory.
+            stat_files=False    = if True, refresh size and mtime even if the listing is cached
+        """
+        key = os.path.abspath(path)
+        dirs = self.dirs
+        try:
+            mtime = os.stat(key).st_mtime_ns
+        except OSError:
+            with self.lock:
+                if dirs.pop(key, None) is not None:
+                    self.__dict__['dirty'] = True
+            return []
+        cached = dirs.get(key)
+        if cached is not None and cached['mtime'] == mtime:
+            if stat_files==True:
+                entries = [_stat_entry(key, e[0], e[1], e[2]) for e in cached['entries']]
+                if entries != cached['entries']:
+                    with self.lock:
+                        cached['entries'] = entries
+                        self.__dict__['dirty'] = True
+                return entries
+            return cached['entries']
+        entries = [_stat_entry(key, name, is_dir, is_link)
+                    for name, is_dir, is_link in _scandir(key)]
+        if time.time() - mtime / 1e9 < self.RACY_SECONDS:
+            mtime = None
+        with self.lock:
+            dirs[key] = {'mtime': mtime, 'entries': entries}
+            self.__dict__['dirty'] = True
+        return entries
+
+    def changes(self, path, stat_files=True, threads=0, followlinks=True):
+        """walk the tree under path, update the index, and return a Dict of the files that
+        were added, removed, or modified since the previous snapshot of path (absolute paths).
+            stat_files=True     = stat every file, so that files edited in place are found.
+                                    If False, only directories whose mtime has changed are
+                                    checked for modified files, which is much faster but
+                                    misses files that were edited in place.
+        """
+        root = os.path.abspath(path)
+        before = self.snapshots.get(root) or {}
+        after = {}
+        seen = set()
+        def scandir(p):
+            entries = self.listing(p, stat_files=stat_files)
+            d = os.path.abspath(p)
+            with self.lock:
+                seen.add(d)
+                for e in entries:
+                    if not e[1]:
+                        after[os.path.join(d, e[0])] = [e[3], e[4]]
+            return [(e[0], e[1], e[2]) for e in entries]
+        for _ in walk(root, scandir=scandir, threads=threads, followlinks=followlinks):
+            pass
+        # drop directories that are no longer in the tree
+        key = os.path.join(root, '')
+        with self.lock:
+            for d in [d for d in self.dirs
+                        if (d + os.sep == key or d.startswith(key)) and d not in seen]:
+                del self.dirs[d]
+            self.snapshots[root] = after
+            self.__dict__['dirty'] = True
+        self.save()
+        return Dict(
+            added=sorted(set(after) - set(before)),
+            removed=sorted(set(before) - set(after)),
+            modified=sorted(fp for fp in after if fp in before and before[fp] != after[fp]))
+
+def _stat_entry(dirpath, name, is_dir, is_link):
+    """[name, is_dir, is_link, size, mtime_ns] for one directory entry"""
+    try:
+        st = os.stat(os.path.join(dirpath, name))
+        return [name, is_dir, is_link, st.st_size, st.st_mtime_ns]
+    except OSError:             # e.g., a broken symlink
+        return [name, is_dir, is_link, None, None]
@@ -1,6 +1,6 @@
 """functions to simplify the testing of a module or package.
 """
-import doctest, unittest, os, sys, inspect
+import doctest, unittest, os, sys, inspect, time
 from bl.rglob import rglob
 
 def list_modules(path, exclude=[]):
@@ -22,3 +22,103 @@ def list_modules(path, exclude=[]):
         if os.path.normpath(os.path.abspath(fn)) not in exclude
     ]
     return modules
+
+class TimingDocTestRunner(doctest.DocTestRunner):
+    """DocTestRunner that records the time taken by each example, and whether it passed"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.examples = []
+
+    def report_start(self, out, test, example):
+        self._example_start = time.perf_counter()
+        super().report_start(out, test, example)
+
+    def _report_end(self, test, example, ok):
+        self.examples.append(dict(
+            test=test.name, lineno=(test.lineno or 0) + example.lineno + 1,
+            source=example.source.strip(), ok=ok, 
+            seconds=time.perf_counter() - self._example_start))
+
+    def report_success(self, out, test, example, got):
+        self._report_end(test, example, True)
+        super().report_success(out, test, example, got)
+
+    def report_failure(self, out, test, example, got):
+        self._report_end(test, example, False)
+        super().report_failure(out, test, example, got)
+
+    def report_unexpected_exception(self, out, test, example, exc_info):
+        self._report_end(test, example, False)
+        super().report_unexpected_exception(out, test, example, exc_info)
+
+def run_module(name):
+    """run the doctests in the named module, return a dict of results and timings:
+        module, attempted, failed, seconds, examples (a list of per-example dicts), 
+        output (the doctest failure report), and error (if the module couldn't be imported).
+    """
+    import importlib, io, traceback
+    result = dict(module=name, attempted=0, failed=0, seconds=0.0, 
+                examples=[], output='', error=None)
+    start = time.perf_counter()
+    try:
+        module = importlib.import_module(name)
+        runner = TimingDocTestRunner()
+        out = io.StringIO()
+        for test in doctest.DocTestFinder().find(module):
+            runner.run(test, out=out.write)
+        result.update(attempted=runner.tries, failed=runner.failures,
+                    examples=runner.examples, output=out.getvalue())
+    except Exception:
+        result.update(error=traceback.format_exc())
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def run_doctests(modules, workers=None, results_fn=None, slowest=10, log=None):
+    """run the doctests in the given modules in a pool of worker processes, return the list
+    of results from run_module(), in the same order as the modules.
+    (There is no thread mode: DocTestRunner swaps sys.stdout and other process-wide state
+    while it runs, so doctests in concurrent threads would capture each other's output.)
+        workers=None        = the size of the pool (None = the number of CPUs)
+        results_fn=None     = if given, write the results to this file as JSON
+        slowest=10          = the number of slowest modules and examples to report
+        log=None            = if given, a Log (or print-like function) for the report
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(run_module, modules))
+    if results_fn is not None:
+        import json
+        with open(results_fn, 'w') as f:
+            json.dump(dict(time=time.time(), results=results), f, indent=2)
+    if log is not None:
+        report(results, slowest=slowest, log=log)
+    return results
+
+def report(results, slowest=10, log=print):
+    """log a summary of doctest results: failures and errors, and the slowest modules and examples"""
+    for result in results:
+        if result['error'] is not None:
+            log("ERROR importing %s:\n%s" % (result['module'], result['error']))
+        elif result['failed'] > 0:
+            log(result['output'])
+    if slowest > 0:
+        log("Slowest modules:")
+        for result in sorted(results, key=lambda r: r['seconds'], reverse=True)[:slowest]:
+            log("  %8.3fs  %s" % (result['seconds'], result['module']))
+        log("Slowest examples:")
+        examples = [(result['module'], example) for result in results 
+                    for example in result['examples']]
+        for module, example in sorted(examples, key=lambda e: e[1]['seconds'], reverse=True)[:slowest]:
+            log("  %8.3fs  %s:%d  %s" % (example['seconds'], module, example['lineno'], 
+                example['source'].split('\n')[0]))
+    log("%d modules, %d examples, %d failed, %d import errors" % (
+        len(results), sum(r['attempted'] for r in results), sum(r['failed'] for r in results),
+        len([r for r in results if r['error'] is not None])))
+
+if __name__ == "__main__":
+    # usage: python -m bl.test PATH [RESULTS.json]
+    path = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else os.getcwd())
+    results = run_doctests(list_modules(path), 
+        results_fn=sys.argv[2] if len(sys.argv) > 2 else None, log=print)
+    sys.exit(int(any(r['failed'] > 0 or r['error'] is not None for r in results)))
@@ -1,41 +1,432 @@
 # zip.py - class for handling ZIP files
 
-from zipfile import ZipFile, ZIP_DEFLATED
-import os, sys
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, ZIP64_LIMIT
+import os, sys, re, struct, zipfile, zlib
+from collections import deque
+from fnmatch import translate
 from bl.dict import Dict
 from bl.log import Log
 
 class ZIP(Dict):
     """zipfile wrapper"""
 
+    # in parallel mode, files larger than this are compressed in the main thread,
+    # streaming from disk, so that no worker holds a whole large file in memory;
+    # and the members in the pool or waiting to be written total at most
+    # PARALLEL_MAX_PENDING bytes (uncompressed), plus their compressed copies.
+    PARALLEL_MAX_SIZE = 2**22
+    PARALLEL_MAX_PENDING = 2**27
+
     def __init__(self, fn=None, mode='r', compression=ZIP_DEFLATED, log=Log(), **args):
         Dict.__init__(self, fn=fn, mode=mode, compression=compression, log=log, **args)
         if fn is not None:
             self.zipfile = ZipFile(self.fn, mode=mode, compression=compression)
 
-    def unzip(self, path=None, members=None, pwd=None):
+    def unzip(self, path=None, members=None, pwd=None, pattern=None, workers=0, processes=False):
+        """extract members (default all) of the archive to path (default the archive's name).
+            pattern=None        = a glob pattern: only extract the members whose names match
+            workers=0           = if > 0, extract in a pool of this many workers, each of 
+                                    which decompresses its share of the members (an archive
+                                    opened from a file object is extracted serially)
+            processes=False     = if True, the pool is a process pool rather than threads
+        """
         if path is None: path = os.path.splitext(self.fn)[0]
         if not os.path.exists(path): os.makedirs(path)
-        self.zipfile.extractall(path=path, members=members, pwd=pwd)
+        if pattern is not None:
+            members = [zinfo.filename for zinfo in self.members(pattern=pattern, names=members)]
+        if workers > 0:
+            _extract_parallel(self.zipfile, path, members, pwd, workers, processes)
+        else:
+            self.zipfile.extractall(path=path, members=members, pwd=pwd)
+
+    def members(self, pattern=None, names=None):
+        """return the ZipInfo of each member, optionally only those whose names are in names
+        or match the glob pattern. Lookups use the archive's central directory, so no member
+        is read or decompressed.
+        """
+        if names is not None:
+            infos = [n if isinstance(n, ZipInfo) else self.zipfile.getinfo(n) for n in names]
+        else:
+            infos = self.zipfile.infolist()
+        if pattern is not None:
+            match = re.compile(translate(pattern)).match
+            infos = [zinfo for zinfo in infos if match(zinfo.filename) is not None]
+        return infos
+
+    def open(self, name, pwd=None):
+        """return a file-like reader for the member name, which decompresses as it is read"""
+        return self.zipfile.open(name, pwd=pwd)
+
+    def read(self, name, pwd=None):
+        """return the (decompressed) contents of the member name"""
+        return self.zipfile.read(name, pwd=pwd)
+
+    def view(self, name):
+        """return a memoryview of the contents of the member name. For stored (uncompressed)
+        members the view is zero-copy: it is a slice of a memory map of the archive. Other 
+        members are decompressed into memory. Release stored views before closing the ZIP.
+        """
+        zinfo = self.zipfile.getinfo(name)
+        if zinfo.compress_type != ZIP_STORED or zinfo.flag_bits & 0x01 \
+        or self.mode != 'r' or not isinstance(self.fn, str):
+            return memoryview(self.zipfile.read(zinfo))
+        if self.__dict__.get('mmap') is None:
+            import mmap
+            with open(self.fn, 'rb') as f:
+                self.__dict__['mmap'] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = _ZipInternals.data_offset(self.zipfile, zinfo)
+        return memoryview(self.__dict__['mmap'])[offset:offset+zinfo.file_size]
 
     def close(self):
         self.zipfile.close()
+        if self.__dict__.get('mmap') is not None:
+            try:
+                self.__dict__.pop('mmap').close()
+            except BufferError:     # views are still in use; the map closes when they're gone
+                pass
 
     @classmethod
-    def zip_path(CLASS, path, fn=None, mode='w', exclude=[], log=Log()):
+    def zip_path(CLASS, path, fn=None, mode='w', exclude=[], log=Log(),
+                workers=0, processes=False, compresslevel=None, exclude_patterns=[]):
+        """zip the files under path into the archive fn (default path + '.zip').
+            exclude=[]          = relative paths of files to leave out (taken literally)
+            exclude_patterns=[] = glob patterns, matched against the relative path, 
+                                    of files to leave out
+            workers=0           = if > 0, compress files in a pool of this many workers
+                                    and write them into the archive in walk order
+            processes=False     = if True, the pool is a process pool rather than threads
+                                    (zlib releases the GIL, so threads are usually enough)
+            compresslevel=None  = the zlib compression level (None is zlib's default)
+        """
         if fn is None:
             fn = path+'.zip'
         zipf = CLASS(fn, mode=mode).zipfile
-        for walk_tuple in os.walk(path):
-            dirfn = walk_tuple[0]
-            for fp in walk_tuple[-1]:
-                walkfn = os.path.join(dirfn, fp)
-                if os.path.relpath(walkfn, path) not in exclude:
-                    zipf.write(walkfn, os.path.relpath(walkfn, path))
+        _write_members(zipf, _walk_path(path, exclude, exclude_patterns), 
+            workers=workers, processes=processes,
+            compresslevel=compresslevel, max_size=CLASS.PARALLEL_MAX_SIZE,
+            max_pending=CLASS.PARALLEL_MAX_PENDING)
         zipf.close()
         return fn
 
+    @classmethod
+    def update_path(CLASS, path, fn=None, exclude=[], log=Log(),
+                workers=0, processes=False, compresslevel=None, exclude_patterns=[],
+                check_crc=False):
+        """update the archive fn (default path + '.zip') to match the files under path.
+        Members whose size and modification time are unchanged are copied over from the 
+        existing archive without being recompressed; new and changed files are compressed, 
+        and files that are no longer in the tree are dropped. The new archive is written 
+        beside the old one and then replaces it. Parameters are as for zip_path(), plus:
+            check_crc=False     = if True, also compare each file's CRC-32 with the member's,
+                                    which reads every file but compresses only changed ones
+        For example, starting from an archive written with data descriptors (as zipfile 
+        does when it writes to a pipe):
+        >>> import tempfile, time
+        >>> tmp = tempfile.mkdtemp(); tree = os.path.join(tmp, 'tree'); fn = tree + '.zip'
+        >>> os.makedirs(tree)
+        >>> for name in ['a.txt', 'b.txt']:
+        ...     with open(os.path.join(tree, name), 'w') as f: _ = f.write(name * 100)
+        ...     os.utime(os.path.join(tree, name), (time.time() - 10,) * 2)
+        >>> r, w = os.pipe()
+        >>> with open(w, 'wb') as pipe, ZipFile(pipe, 'w', ZIP_DEFLATED) as zf:
+        ...     for name in ['a.txt', 'b.txt']: zf.write(os.path.join(tree, name), name)
+        >>> with open(r, 'rb') as pipe, open(fn, 'wb') as f: _ = f.write(pipe.read())
+        >>> ZipFile(fn).getinfo('a.txt').flag_bits & 0x08      # data descriptor
+        8
+        >>> with open(os.path.join(tree, 'b.txt'), 'w') as f: _ = f.write('changed')
+        >>> with open(os.path.join(tree, 'c.txt'), 'w') as f: _ = f.write('new')
+        >>> ZIP.update_path(tree) == fn
+        True
+        >>> zf = ZipFile(fn); zf.testzip() is None
+        True
+        >>> [(name, zf.read(name)[:7]) for name in sorted(zf.namelist())]
+        [('a.txt', b'a.txta.'), ('b.txt', b'changed'), ('c.txt', b'new')]
+        >>> zf.getinfo('a.txt').flag_bits & 0x08               # copied, header rewritten
+        0
+        >>> zf.close()
+
+        If the update fails, the existing archive is left as it was:
+        >>> os.symlink(os.path.join(tmp, 'missing'), os.path.join(tree, 'broken'))
+        >>> ZIP.update_path(tree)                # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        FileNotFoundError: ...
+        >>> sorted(os.listdir(tmp)), ZipFile(fn).testzip()
+        (['tree', 'tree.zip'], None)
+        >>> import shutil; shutil.rmtree(tmp)
+        """
+        if fn is None:
+            fn = path+'.zip'
+        if not os.path.exists(fn):
+            return CLASS.zip_path(path, fn=fn, exclude=exclude, log=log, workers=workers, 
+                processes=processes, compresslevel=compresslevel, 
+                exclude_patterns=exclude_patterns)
+        source = ZipFile(fn, mode='r')
+        try:
+            zipf = CLASS(fn+'.tmp', mode='w').zipfile
+            try:
+                _write_members(zipf, _walk_path(path, exclude, exclude_patterns), workers=workers, 
+                    processes=processes, compresslevel=compresslevel, 
+                    max_size=CLASS.PARALLEL_MAX_SIZE, max_pending=CLASS.PARALLEL_MAX_PENDING, 
+                    source=source, check_crc=check_crc)
+            except BaseException:
+                # discard the partial archive
+                try:
+                    zipf.close()
+                finally:
+                    os.remove(fn+'.tmp')
+                raise
+            zipf.close()
+        finally:
+            source.close()
+        os.replace(fn+'.tmp', fn)
+        return fn
+
+def _walk_path(path, exclude, exclude_patterns=[]):
+    """yield (filename, arcname) for the files under path that are not excluded"""
+    excluded = _excluder(exclude, exclude_patterns)
+    for walk_tuple in os.walk(path):
+        dirfn = walk_tuple[0]
+        for fp in walk_tuple[-1]:
+            walkfn = os.path.join(dirfn, fp)
+            arcname = os.path.relpath(walkfn, path)
+            if not excluded(arcname):
+                yield walkfn, arcname
+
+def _excluder(exclude, exclude_patterns=[]):
+    """return a function that is True for relative paths that are in exclude (literal
+    relative paths) or that match one of exclude_patterns (glob patterns).
+    >>> excluded = _excluder(['a.txt', 'data[1].txt'], ['*.pyc', 'build/*'])
+    >>> [excluded(p) for p in ['a.txt', 'b.txt', 'x/y.pyc', 'build/lib/z.py']]
+    [True, False, True, True]
+    >>> [excluded(p) for p in ['data[1].txt', 'data1.txt']]
+    [True, False]
+    """
+    literals = set(os.path.normpath(p) for p in exclude)
+    patterns = [translate(os.path.normpath(p)) for p in exclude_patterns]
+    regex = re.compile('|'.join(patterns)) if len(patterns) > 0 else None
+    def excluded(relpath):
+        relpath = os.path.normpath(relpath)
+        return relpath in literals or (regex is not None and regex.match(relpath) is not None)
+    return excluded
+
+def _compress_file(filename, compress_type, compresslevel):
+    """read and compress one file, return (CRC, file_size, compressed data)"""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    crc = zlib.crc32(data)
+    file_size = len(data)
+    if compress_type == ZIP_DEFLATED:
+        if compresslevel is None:
+            compresslevel = zlib.Z_DEFAULT_COMPRESSION
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    return crc, file_size, data
+
+class _ZipInternals:
+    """the private parts of zipfile that the raw (not recompressing) writer and reader use,
+    kept in one place. Checked against the zipfile module of CPython 3.11.
+    """
+    @classmethod
+    def append(CLASS, zipf, zinfo, chunks, zip64=False):
+        """write the local header of zinfo and then chunks at the end of the members of the
+        (seekable) ZipFile zipf, and add zinfo to its central directory
+        """
+        with zipf._lock:
+            zipf.fp.seek(zipf.start_dir)
+            zinfo.header_offset = zipf.fp.tell()
+            zipf._writecheck(zinfo)
+            zipf._didModify = True
+            zipf.fp.write(zinfo.FileHeader(zip64))
+            for chunk in chunks:
+                zipf.fp.write(chunk)
+            zipf.start_dir = zipf.fp.tell()
+            zipf.filelist.append(zinfo)
+            zipf.NameToInfo[zinfo.filename] = zinfo
+
+    @classmethod
+    def read_at(CLASS, zipf, offset, size):
+        """read up to size bytes at offset in the archive of the ZipFile zipf"""
+        with zipf._lock:
+            zipf.fp.seek(offset)
+            return zipf.fp.read(size)
+
+    @classmethod
+    def data_offset(CLASS, zipf, zinfo):
+        """the offset in the archive of the first byte of the member zinfo's (compressed) data"""
+        size = zipfile.sizeFileHeader
+        fheader = struct.unpack(zipfile.structFileHeader, 
+            CLASS.read_at(zipf, zinfo.header_offset, size))
+        return zinfo.header_offset + size + fheader[10] + fheader[11]
+
+    @classmethod
+    def strip_zip64_extra(CLASS, extra):
+        """extra without its zip64 field"""
+        return zipfile._strip_extra(extra, (1,))
+
+    @classmethod
+    def sanitize_windows_name(CLASS, zipf, arcname):
+        """arcname with the characters that are illegal in Windows file names replaced"""
+        return zipf._sanitize_windows_name(arcname, os.path.sep)
+
+def _write_raw(zipf, zinfo, data):
+    """write an already-compressed member into the (seekable) ZipFile zipf.
+    zinfo must have its compress_type, CRC, and file_size set. data is either bytes or
+    an iterable of byte chunks, in which case zinfo.compress_size must also be set.
+    """
+    if isinstance(data, bytes):
+        zinfo.compress_size = len(data)
+        data = [data]
+    zinfo.flag_bits &= ~0x08        # sizes are in the local header, not a data descriptor
+    if not zinfo.external_attr:
+        zinfo.external_attr = 0o600 << 16
+    zip64 = zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT
+    _ZipInternals.append(zipf, zinfo, data, zip64=zip64)
+
+def _read_raw(zipf, zinfo, chunk_size=2**20):
+    """return an iterator over the compressed bytes of the member zinfo in the ZipFile zipf.
+    The member's position is read now, so zinfo can be modified before the iterator is used.
+    """
+    offset = _ZipInternals.data_offset(zipf, zinfo)
+    def chunks(offset, left):
+        while left > 0:
+            chunk = _ZipInternals.read_at(zipf, offset, min(chunk_size, left))
+            if not chunk:
+                raise EOFError("truncated member %s in %s" % (zinfo.filename, zipf.filename))
+            offset += len(chunk)
+            left -= len(chunk)
+            yield chunk
+    return chunks(offset, zinfo.compress_size)
+
+def _copy_member(zipf, source, zinfo):
+    """copy the member zinfo from the ZipFile source into zipf without recompressing it"""
+    zinfo.extra = _ZipInternals.strip_zip64_extra(zinfo.extra)  # FileHeader() adds its own
+    _write_raw(zipf, zinfo, _read_raw(source, zinfo))
+
+def _unchanged(zinfo, walkfn, source, compress_type, check_crc):
+    """the member of source that matches the file walkfn (as zinfo), or None if it has changed"""
+    if source is None:
+        return None
+    try:
+        old = source.getinfo(zinfo.filename)
+    except KeyError:
+        return None
+    # ZIP timestamps have 2-second resolution
+    dt = zinfo.date_time[:5] + (zinfo.date_time[5] // 2 * 2,)
+    if old.file_size != zinfo.file_size or old.date_time != dt \
+    or old.compress_type != compress_type or old.flag_bits & 0x01:
+        return None
+    if check_crc==True:
+        crc = 0
+        with open(walkfn, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                crc = zlib.crc32(chunk, crc)
+        if crc != old.CRC:
+            return None
+    return old
+
+def _write_members(zipf, walkfns, workers=0, processes=False, compresslevel=None, 
+        max_size=2**22, max_pending=2**27, source=None, check_crc=False):
+    """write (filename, arcname) pairs to zipf in order, copying unchanged members from the
+    ZipFile source if given. With workers > 0, files of up to max_size bytes are compressed
+    in a pool. Submitted files that haven't been written yet total at most max_pending bytes,
+    so memory use is bounded by about max_pending plus the compressed copies.
+    """
+    compress_type = zipf.compression
+    if workers > 0:
+        if processes==True:
+            from concurrent.futures import ProcessPoolExecutor as Executor
+        else:
+            from concurrent.futures import ThreadPoolExecutor as Executor
+        executor = Executor(max_workers=workers)
+    else:
+        executor = None
+    pending = deque()
+    pending_size = 0
+    def write_next():
+        nonlocal pending_size
+        zinfo, future = pending.popleft()
+        pending_size -= zinfo.file_size
+        zinfo.CRC, zinfo.file_size, data = future.result()
+        _write_raw(zipf, zinfo, data)
+    try:
+        for walkfn, arcname in walkfns:
+            zinfo = ZipInfo.from_file(walkfn, arcname)
+            zinfo.compress_type = compress_type
+            old = _unchanged(zinfo, walkfn, source, compress_type, check_crc)
+            if executor is not None and old is None and not zinfo.is_dir() \
+            and zinfo.file_size <= max_size and compress_type in [ZIP_DEFLATED, ZIP_STORED]:
+                while len(pending) > 0 and pending_size + zinfo.file_size > max_pending:
+                    write_next()
+                pending.append(
+                    (zinfo, executor.submit(_compress_file, walkfn, compress_type, compresslevel)))
+                pending_size += zinfo.file_size
+                continue
+            while len(pending) > 0:
+                write_next()
+            if old is not None:
+                _copy_member(zipf, source, old)
+            else:
+                zipf.write(walkfn, arcname, compresslevel=compresslevel)
+        while len(pending) > 0:
+            write_next()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+def _extract_members(fn, names, path, pwd):
+    """extract the named members of the archive fn to path, using a ZipFile of its own"""
+    with ZipFile(fn, mode='r') as zipf:
+        for name in names:
+            zipf.extract(name, path=path, pwd=pwd)
+    return len(names)
+
+def _extract_target(zipf, zinfo, path):
+    """the path to which zipf.extract(zinfo, path) writes the member, with the member name
+    cleaned up the same way zipfile does it (no drive, no '', '.', or '..' parts).
+    """
+    arcname = zinfo.filename.replace('/', os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    arcname = os.path.sep.join(x for x in arcname.split(os.path.sep) 
+                                if x not in ('', os.path.curdir, os.path.pardir))
+    if os.path.sep == '\\':
+        arcname = _ZipInternals.sanitize_windows_name(zipf, arcname)
+    return os.path.normpath(os.path.join(path, arcname))
+
+def _extract_parallel(zipf, path, members, pwd, workers, processes):
+    """extract members (default all) of the ZipFile zipf to path in a pool of workers.
+    Members are dealt out largest first into 4 batches per worker, so the batches are
+    of similar size. Each worker opens the archive by name, so an archive opened from 
+    a file object is extracted serially.
+    """
+    if not isinstance(zipf.filename, str) or not os.path.isfile(zipf.filename):
+        zipf.extractall(path=path, members=members, pwd=pwd)
+        return
+    if processes==True:
+        from concurrent.futures import ProcessPoolExecutor as Executor
+    else:
+        from concurrent.futures import ThreadPoolExecutor as Executor
+    if members is None:
+        infos = zipf.infolist()
+    else:
+        infos = [m if isinstance(m, ZipInfo) else zipf.getinfo(m) for m in members]
+    # create the directories first, so that the workers don't race to create them
+    dirs = set()
+    for zinfo in infos:
+        target = _extract_target(zipf, zinfo, path)
+        dirs.add(target if zinfo.is_dir() else os.path.dirname(target))
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+    infos.sort(key=lambda zinfo: zinfo.compress_size, reverse=True)
+    batches = [[] for i in range(workers * 4)]
+    for i, zinfo in enumerate(infos):
+        batches[i % len(batches)].append(zinfo.filename)
+    with Executor(max_workers=workers) as executor:
+        for future in [executor.submit(_extract_members, zipf.filename, batch, path, pwd)
+                        for batch in batches if len(batch) > 0]:
+            future.result()
+
 if __name__=='__main__':
     for path in sys.argv[1:]:
         print(ZIP.zip_path(path))
-